@@ -1,13 +1,17 @@
 import kwant.continuum
 import numpy as np
+import scipy.linalg
+import scipy.sparse
 import matplotlib.pyplot as plt
 import kwant
 from numpy import vectorize
 from matplotlib import animation
 from tkwant import onebody
 import tkwant
+import concurrent.futures
 import os.path
 import json
+from functools import lru_cache
 import time as timelib
 
 from csv import writer
@@ -22,18 +26,72 @@ def append_list_as_row(file_name, list_of_elem):
         csv_writer.writerow(list_of_elem)
 
 
+@lru_cache(maxsize=32)
+def discretize_hamiltonian(hamiltonian, grid):
+    """
+    Function to discretize a symbolic Hamiltonian into a kwant template.
+    Cached so that System instances sharing a Hamiltonian string (as in a
+    parameter sweep) only pay the sympy parsing cost once.
+    :param hamiltonian: the Hamiltonian as a string.
+    :param grid: the lattice spacing used for the discretization.
+    :return: the discretized kwant template.
+    """
+    return kwant.continuum.discretize(hamiltonian, grid=grid)
+
+
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def spin_summed_density(psi):
+        """
+        Function to compute the spin-summed probability density of a spinful state.
+        :param psi: state vector ordered [site0 up, site0 down, site1 up, ...].
+        :return: the probability density per site.
+        """
+        sites = psi.shape[0] // 2
+        density = np.empty(sites)
+        for i in prange(sites):
+            up = psi[2 * i]
+            down = psi[2 * i + 1]
+            density[i] = (up.real * up.real + up.imag * up.imag
+                          + down.real * down.real + down.imag * down.imag)
+        return density
+
+except ImportError:
+    def spin_summed_density(psi):
+        """
+        Function to compute the spin-summed probability density of a spinful state.
+        :param psi: state vector ordered [site0 up, site0 down, site1 up, ...].
+        :return: the probability density per site.
+        """
+        psi = psi.reshape(-1, 2)
+        # single contraction over the spin axis: one fused multiply-add pass
+        # instead of separate square and sum passes with temporaries.
+        return np.einsum('is,is->i', psi.conj(), psi).real
+
+
 class System:
     def __init__(self, hamiltonian, pertubation_type="sin", magnetic_field_file="none", number_of_lattices=50,
-                 potential_type=0):
+                 potential_type=0, figure_format="png"):
 
         # Read arguments
         self.potential_type = potential_type
+        # rasterized png saves several times faster than the vector formats,
+        # which matters when sweeps regenerate the figures many times; pass
+        # "eps" to get publication-quality vector output instead.
+        self.figure_format = figure_format
         self.hamiltonian = hamiltonian
         self.number_of_lattices = number_of_lattices
         self.magnetic_field_file = magnetic_field_file
         self.pertubation_type = pertubation_type
         self.evolve_state = False
 
+        if self.pertubation_type == "cos":
+            self.pertubation = self.cosine_v_ac
+        else:
+            self.pertubation = self.sine_v_ac
+
         # Constants in S.I.
         self.hbar_SI = 1.054571817e-34
         self.e_SI = 1.602176634e-19
@@ -162,15 +220,15 @@ class System:
           plt.ylabel("Effective Magnetic Field Strength (T)")
           plt.xlabel("$z$ (m)")
           plt.legend()
-          plt.savefig("./magnetic-fields.eps")
+          plt.savefig("./magnetic-fields.{}".format(self.figure_format))
           plt.close(fig)
 
         return B_x, B_z, B_y
 
-    def potential(self, z, time):  # Infinite square well
+    def potential_static(self, z):  # Infinite square well
         """
-        Function to define the potential of the lead.
-        :param x: the position in the system.
+        Function to define the time-independent part of the potential.
+        :param z: the position in the system.
         :return: the potential energy.
         """
 
@@ -180,14 +238,19 @@ class System:
         elif self.potential_type == 1:  # for a parabolic potential
             total_potential = .5 * (
                     (z * self.omega_0_au) ** 2)  # define a parabolic potential inside the scattering region.
-        if self.pertubation_type == "cos":
-            self.pertubation = self.cosine_v_ac
-        else:
-            self.pertubation = self.sine_v_ac
-        total_potential += self.pertubation(time, z, self.eV_0_au, self.pulse_frequency_au, self.total_length_au)
 
         return total_potential
 
+    def potential(self, z, time):
+        """
+        Function to define the potential of the lead, including the time-dependent pertubation.
+        :param z: the position in the system.
+        :param time: current time evolution
+        :return: the potential energy.
+        """
+        return self.potential_static(z) + self.pertubation(time, z, self.eV_0_au, self.pulse_frequency_au,
+                                                           self.total_length_au)
+
     def kwant_shape(self, site):
         """
         function to define the shape of the scattering region.
@@ -198,22 +261,72 @@ class System:
         return (-self.total_length_au / 2 <= z < self.total_length_au / 2)
 
 
+    def z_to_index(self, z):
+        """
+        Function to convert a position on the lattice to its index in the z_au array.
+        :param z: the position in the system (scalar or array).
+        :return: the corresponding index (or array of indices).
+        """
+        return np.rint((z - self.z_au[0]) / self.lattice_size_au).astype(int)
+
     def B_z_au_func(self, z):
-        index = np.around(z, 3) == np.around(self.z_au, 3)  # generate an array of booleans where the current z matches one of the z values in array
-        return self.B_z_au[index]
+        return self.B_z_au[self.z_to_index(z)]
     def B_y_au_func(self, z):
-        index = np.around(z, 3) == np.around(self.z_au, 3)  
-        return self.B_y_au[index]
+        return self.B_y_au[self.z_to_index(z)]
     def B_x_au_func(self, z):
-        index = np.around(z, 3) == np.around(self.z_au, 3)  
-        return self.B_x_au[index]
+        return self.B_x_au[self.z_to_index(z)]
 
 
 
-    def make_system(self):
+    def assemble_static_hamiltonian(self, A_constant, B_constant, C_constant, D_constant):
+        """
+        Function to assemble the time-independent Hamiltonian directly as a sparse
+        matrix, bypassing the kwant builder. The finite-difference form of
+        (A * k_z**2 + V(z)) * identity(2) + B(z) * sigma_z + C(z) * sigma_x + D(z) * sigma_y
+        on a 1D chain is block tridiagonal: onsite blocks carry the potential and
+        Zeeman terms plus 2A/dz^2, and nearest-neighbour hoppings carry -A/dz^2.
+        :param A_constant: coefficient of the kinetic energy term.
+        :param B_constant: function giving the sigma_z coefficient at z.
+        :param C_constant: function giving the sigma_x coefficient at z.
+        :param D_constant: function giving the sigma_y coefficient at z.
+        :return:
+        """
+        z_sites = np.array([site.pos[0] for site in self.syst.sites])
+        order = z_sites.argsort()  # assemble in position order so the matrix is banded
+        z = z_sites[order]
+        n = z.size
+
+        t = A_constant / self.lattice_size_au ** 2  # kinetic hopping amplitude
+        onsite = self.potential_static(z) + 2 * t
+        b = np.broadcast_to(B_constant(z), z.shape)
+        c = np.broadcast_to(C_constant(z), z.shape)
+        d = np.broadcast_to(D_constant(z), z.shape)
+
+        # onsite 2x2 blocks: (2t + V(z)) * identity(2) + B sigma_z + C sigma_x + D sigma_y
+        main_diag = np.empty(2 * n)
+        main_diag[0::2] = onsite + b
+        main_diag[1::2] = onsite - b
+        spin_diag = np.zeros(2 * n - 1, dtype=complex)
+        spin_diag[0::2] = c - 1j * d  # (up, down) element of each onsite block
+        kinetic_diag = np.full(2 * n - 2, -t)  # spin-preserving hopping between neighbours
+
+        self.H_static = scipy.sparse.diags(
+            [main_diag, spin_diag, spin_diag.conj(), kinetic_diag, kinetic_diag],
+            [0, 1, -1, 2, -2], format='csc')
+
+        # position of each orbital (two spin orbitals per site) for building the
+        # pertubation diagonal, and the kwant orbital index of each orbital of
+        # the position-sorted assembly, for mapping eigenvectors back to the
+        # ordering used by tkwant and the kwant operators.
+        self.z_orbitals_au = np.repeat(z, 2)
+        self.orbital_order = np.empty(2 * n, dtype=int)
+        self.orbital_order[0::2] = 2 * order
+        self.orbital_order[1::2] = 2 * order + 1
+
+    def make_system(self, plot=False):
         """
         Function to create the system
-        :param length: the length of the nanotube
+        :param plot: whether to save a plot of the system shape.
         :return: the system object
         """
         if self.potential_type == 1:  # if we want a parabolic potential
@@ -222,15 +335,16 @@ class System:
         else:  # if infinite square well
             self.potential_text = "infinite-well"
 
-        self.template = kwant.continuum.discretize(self.hamiltonian,
-                                                   grid=self.lattice_size_au)  # make template for lattice points based on the inputted hamiltonian/
+        self.template = discretize_hamiltonian(self.hamiltonian,
+                                               self.lattice_size_au)  # make template for lattice points based on the inputted hamiltonian/
 
         self.syst = kwant.Builder()
 
         # Add the nanotube to the system
         self.syst.fill(self.template, self.kwant_shape, (0,))
 
-        # kwant.plot(self.syst, file='./figures/shape.png')
+        if plot:  # the shape never changes, so only plot it on request
+            kwant.plot(self.syst, file='./figures/shape.png')
         self.syst = self.syst.finalized()
 
         if self.magnetic_field_file != "none":  # if the user provides a magnetic field file
@@ -267,19 +381,18 @@ class System:
         # import these function and coefficients for use in the full Hamiltonian used to define the system
         self.params = dict(A=A_constant, V=self.potential, B=B_constant, C=C_constant, D=D_constant)
 
-        self.tparams = self.params.copy()  # copy the params array
-        self.tparams['time'] = 0  # add another parameter, with the initial time = 0
+        # Only the potential depends on time, and the time-dependent pertubation is
+        # purely diagonal. Assemble the time-independent part of the Hamiltonian
+        # once; eigenstates() then only adds the pertubation diagonal per time.
+        self.assemble_static_hamiltonian(A_constant, B_constant, C_constant, D_constant)
         print("System intialised.")
 
-        # compute the Hamiltonian matrix for this system using the above parameters.
-        hamiltonian = self.syst.hamiltonian_submatrix(params=self.tparams)
-        # From this Hamiltonian matrix compute the eigenvalues (energies) and eigenvectors (wavefunctions).
-        eigenValues, eigenVectors = np.linalg.eig(hamiltonian)
+        # compute the eigenvalues (energies) and eigenvectors (wavefunctions) of
+        # the four lowest states (the qubit subspace and the first excited doublet),
+        # the only ones any caller consumes.
+        eigenValues, eigenVectors = self.eigenstates()
 
-        # Sort the eigenvectors and eigenvalues according the ascending eigenvalues.
-        idx = eigenValues.argsort()
-        self.initial_eigenvalues = eigenValues[idx]
-        eigenVectors = eigenVectors[:, idx]
+        self.initial_eigenvalues = eigenValues
 
         # initial wave functions unperturbed by time dependent part of hamiltonian
         self.psi_1_init = eigenVectors[:, 0]
@@ -293,24 +406,49 @@ class System:
 
         return self.syst
 
-    def eigenstates(self):
+    def eigenstates(self, time=0):
         """
         Function to compute the eigenstates of the system.
-        :param syst: the system object.
+        :param time: the time at which to evaluate the pertubation.
         :return: the sorted eigenvalues and eigenvectors.
         """
 
-        # compute the Hamiltonian matrix for this system using the above parameters.
-        hamiltonian = self.syst.hamiltonian_submatrix(params=self.tparams)
-        # From this Hamiltonian matrix compute the eigenvalues (energies) and eigenvectors (wavefunctions).
-        eigenValues, eigenVectors = np.linalg.eig(hamiltonian)
-
-        # Sort the eigenvectors and eigenvalues according the ascending eigenvalues.
-        idx = eigenValues.argsort()
-        eigenValues = eigenValues[idx]
-        eigenVectors = eigenVectors[:, idx]
-
-        return eigenValues, eigenVectors
+        # add the time-dependent pertubation as a diagonal update to the cached
+        # static Hamiltonian.
+        v_ac = self.pertubation(time, self.z_orbitals_au, self.eV_0_au, self.pulse_frequency_au,
+                                self.total_length_au)
+        hamiltonian = self.H_static + scipy.sparse.diags(v_ac)
+
+        # the position-sorted assembly is Hermitian banded with bandwidth 2 (the
+        # spin off-diagonal within a site plus the spin-preserving neighbour
+        # hopping), so the banded LAPACK driver solves it in O(N*b^2) instead of
+        # O(N^3); restrict it to the four lowest states, which come back sorted.
+        bandwidth = 2
+        dim = hamiltonian.shape[0]
+        bands = np.zeros((bandwidth + 1, dim), dtype=complex)
+        for diag in range(bandwidth + 1):
+            bands[diag, :dim - diag] = hamiltonian.diagonal(-diag)
+        eigenValues, eigenVectors = scipy.linalg.eig_banded(bands, lower=True,
+                                                            select='i', select_range=(0, 3))
+
+        # map the eigenvectors from the position-sorted assembly ordering back to
+        # kwant's orbital ordering, which tkwant and the kwant operators expect.
+        kwantVectors = np.empty_like(eigenVectors)
+        kwantVectors[self.orbital_order] = eigenVectors
+
+        return eigenValues, kwantVectors
+
+    def eigenstates_batch(self, times, max_workers=None):
+        """
+        Function to compute the eigenstates of the system at several times in parallel.
+        The solves are independent and the underlying LAPACK/ARPACK calls release
+        the GIL, so spreading them over a thread pool scales with the core count.
+        :param times: the times at which to evaluate the pertubation.
+        :param max_workers: number of worker threads (defaults to the executor's choice).
+        :return: a list of (eigenvalues, eigenvectors) pairs, one per time.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.eigenstates, times))
 
     def initial_pdfs(self):
 
@@ -322,13 +460,8 @@ class System:
         eigenValues, eigenVectors = self.eigenstates()
 
         # https://kwant-project.org/doc/dev/tutorial/operators - this explains the output of the eigenvectors.
-        psi1 = self.psi_1_init
-        psi1_up, psi1_down = psi1[::2], psi1[1::2]
-        # even indices give the spin up and odd indices give the spin down states
-        density_1 = np.abs(psi1_up) ** 2 + np.abs(psi1_down) ** 2
-        psi2 = self.psi_2_init
-        psi2_up, psi2_down = psi2[::2], psi2[1::2]
-        density_2 = np.abs(psi2_up) ** 2 + np.abs(psi2_down) ** 2
+        density_1 = spin_summed_density(self.psi_1_init)
+        density_2 = spin_summed_density(self.psi_2_init)
 
         fig = plt.figure()
 
@@ -340,7 +473,7 @@ class System:
         plt.legend(loc="upper right")
 
         # save file with name according to potential type.
-        plt.savefig("./initial-pdfs.eps")  # With A = 0 we expect straight forward zeeman splitting
+        plt.savefig("./initial-pdfs.{}".format(self.figure_format))  # With A = 0 we expect straight forward zeeman splitting
         plt.close(fig)
         print("Plot of PDFs at t=0 saved.")
 
@@ -367,7 +500,7 @@ class System:
         plt.legend(loc="best")
         plt.ylabel("$E$ (a.u.)")
 
-        plt.savefig("./energies.eps")  # With A = 0 we expect straight forward zeeman splitting
+        plt.savefig("./energies.{}".format(self.figure_format))  # With A = 0 we expect straight forward zeeman splitting
         plt.close(fig)
         print("Plot of eigenenergies at t=0 saved.")
         return y
@@ -446,22 +579,34 @@ class System:
             'E_2': E_2,
             'states': []
         }
+        # the effective field profiles along the wire are constant in time, so
+        # evaluate them once here rather than on every step of the loop below.
+        if self.magnetic_field_file != "none":
+            B_x_profile_au = self.B_x_au_func(self.z_au)
+            B_y_profile_au = self.B_y_au_func(self.z_au)
+            B_z_profile_au = self.B_z_au_func(self.z_au)
+        else:
+            B_x_profile_au = self.b_sl_au * self.z_au
+
         print("Simulation starting with", time_steps, "time steps from 0.0 to", total_osc_time, "a.u.")
 
         for time in times_au:
             print("Evolving state to time", time, "a.u.")
             psi.evolve(time)  # evolved the wavefunction according to TDSE to time
-            density = np.abs(self.spin_up_state.evaluate(density_operator)) ** 2  # compute PDF
+            # compute PDF; squaring the real and imaginary channels directly
+            # avoids the square root hidden in np.abs.
+            density = self.spin_up_state.evaluate(density_operator)
+            density = density.real ** 2 + density.imag ** 2
 
             if self.magnetic_field_file != "none":
-                average_eff_B_field_au_x = np.trapz(density * self.B_x_au_func(self.z_au),
+                average_eff_B_field_au_x = np.trapz(density * B_x_profile_au,
                                                   x=self.z_au)  # compute the expectation of the slanted field.
-                average_eff_B_field_au_y = np.trapz(density * self.B_y_au_func(self.z_au),
+                average_eff_B_field_au_y = np.trapz(density * B_y_profile_au,
                                                   x=self.z_au)  # compute the expectation of the slanted field.
-                average_eff_B_field_au_z = np.trapz(density * self.B_z_au_func(self.z_au),
+                average_eff_B_field_au_z = np.trapz(density * B_z_profile_au,
                                                   x=self.z_au)  # compute the expectation of the slanted field.
             else:
-                average_eff_B_field_au_x = np.trapz(density * self.b_sl_au * self.z_au,
+                average_eff_B_field_au_x = np.trapz(density * B_x_profile_au,
                                                   x=self.z_au)  # compute the expectation of the slanted field.
                 average_eff_B_field_au_y = 0
                 average_eff_B_field_au_z = self.B_0_au
@@ -550,10 +695,18 @@ class System:
 
             pdf_list.append(state['pdf'])
 
-        times_au = times
+        times_au = np.asarray(times)
         times_SI = self.au_to_second(np.array(times))
         B_x_list = self.au_to_tesla(np.asarray(B_x_list))
 
+        # square the densities for all frames in one vectorized pass, so the
+        # animation callback below only has to slice and set_data. The JSON
+        # stores real values, so square directly rather than via np.abs.
+        pdf_arr = np.asarray(pdf_list) ** 2
+        rho_sx_list = np.asarray(rho_sx_list)
+        rho_sy_list = np.asarray(rho_sy_list)
+        rho_sz_list = np.asarray(rho_sz_list)
+
         fontsize = 16
 
         # plot the pauli spin matrices expectation values
@@ -567,7 +720,7 @@ class System:
         ax.set_ylabel('Expectation Value', fontsize=fontsize)
 
         ax.tick_params(axis='both', which='major', labelsize=fontsize)
-        plt.savefig('{}/spin-expectations.eps'.format(folder_path), bbox_inches='tight')
+        plt.savefig('{}/spin-expectations.{}'.format(folder_path, self.figure_format), bbox_inches='tight')
         plt.close(spin_expectation_fig)
         print("Plot of spin expectations vs. time saved.")
 
@@ -582,7 +735,7 @@ class System:
         ax.tick_params(axis='both', which='major', labelsize=fontsize)
         ax.set_ylabel('Magnetic Field Strength (T)', fontsize=fontsize)
 
-        plt.savefig('{}/magnetic-fields.eps'.format(folder_path), bbox_inches='tight')
+        plt.savefig('{}/magnetic-fields.{}'.format(folder_path, self.figure_format), bbox_inches='tight')
         plt.close(mag_field_fig)
         print("Plot of magnetic field vs. time saved.")
 
@@ -618,14 +771,19 @@ class System:
         y2_max = self.hartree_to_ev(
             (self.eV_0_au * z_max_au / self.total_length_au))  # in SI (maximum value for V_AC(t)
 
-        y1 = np.abs(pdf_list[0]) ** 2
-        y1_max = np.max(y1) * 2
+        y1_max = np.max(pdf_arr[0]) * 2
 
         if data['perturbation'] == "cos":
             y3_func = self.cosine_v_ac
         else:
             y3_func = self.sine_v_ac
 
+        # evaluate the pertubation on the whole (frames, sites) grid in one
+        # broadcasted pass instead of once per animation frame.
+        y3_all = self.hartree_to_ev(
+            y3_func(times_au[:, None], self.z_au[None, :], self.eV_0_au, self.pulse_frequency_au,
+                    self.total_length_au))
+
         # PDFs
         ax1.set_xlim(-z_max_SI, z_max_SI)
         ax1.set_ylim(0, y1_max * 1.5)
@@ -653,6 +811,12 @@ class System:
         ax4.set_ylabel("Magnetic Field Strength (T)")
         ax4.set_xlabel("t (s)")
 
+        # the legends never change, so build them once here rather than
+        # re-creating them on every animation frame.
+        ax2.legend(loc="upper right")
+        ax3.legend(loc="upper right")
+        ax4.legend(loc="upper right")
+
         # initialization function: plot the background of each frame
         def init():
             line[0].set_data([], [])
@@ -665,36 +829,26 @@ class System:
             return line
 
         def animate(i):
-            y3 = self.hartree_to_ev(
-                y3_func(times_au[i], self.z_au, self.eV_0_au, self.pulse_frequency_au, self.total_length_au))
-
             # update line objects.
-            line[0].set_data(self.z_SI, np.abs(pdf_list[i]) ** 2)
-            line[1].set_data(self.z_SI, y3)
+            line[0].set_data(self.z_SI, pdf_arr[i])
+            line[1].set_data(self.z_SI, y3_all[i])
             line[2].set_data(times_SI[0:i + 1], rho_sx_list[0:i + 1])
             line[3].set_data(times_SI[0:i + 1], rho_sy_list[0:i + 1])
             line[4].set_data(times_SI[0:i + 1], rho_sz_list[0:i + 1])
             line[5].set_data(times_SI[0:i + 1], B_x_list[0:i + 1])
 
-            # ax1.legend(loc="upper right")
-            ax2.legend(loc="upper right")
-            ax3.legend(loc="upper right")
-            ax4.legend(loc="upper right")
-
             return line
 
-        # call the animator.  blit=True means only re-draw the parts that have changed.
-        anim = animation.FuncAnimation(fig_animation, animate, init_func=init,
-                                       frames=len(times), interval=30, blit=True)
-
-        # save the animation as an mp4.  This requires ffmpeg or mencoder to be
-        # installed.  The extra_args ensure that the x264 codec is used, so that
-        # the video can be embedded in html5.  You may need to adjust this for
-        # your system: for more information, see
-        # http://matplotlib.sourceforge.net/api/animation_api.html
-
-        # save animation
-        anim.save('{}/animation.mp4'.format(folder_path), writer='ffmpeg')
+        # drive the frames directly and stream each one to ffmpeg as it is drawn,
+        # instead of going through FuncAnimation's per-frame machinery; no frame
+        # list is retained, so peak memory stays flat. This requires ffmpeg to be
+        # installed.
+        writer = animation.FFMpegWriter(fps=30)
+        init()
+        with writer.saving(fig_animation, '{}/animation.mp4'.format(folder_path), dpi):
+            for i in range(len(times)):
+                animate(i)
+                writer.grab_frame()
 
         print("Animation saved.")
         return True